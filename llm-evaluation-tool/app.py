@@ -1,6 +1,13 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, g
 from flask_cors import CORS
 import os
+import cProfile
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 import gspread
 from google.oauth2.service_account import Credentials
@@ -25,6 +32,81 @@ openai_client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
 anthropic_client = Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY'))
 genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
 
+# Request tracing and profiling (opt-in)
+ENABLE_TRACING = os.getenv('ENABLE_TRACING', 'false').lower() == 'true'
+PROFILE_DIR = os.getenv('PROFILE_DIR')
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0.1'))
+PROFILE_SLOW_MS = float(os.getenv('PROFILE_SLOW_MS', '2000'))
+
+@contextmanager
+def trace_span(name):
+    """Record how long a stage of the current request takes (no-op when tracing is off)"""
+    spans = g.get('trace_spans')
+    if spans is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans.append((name, (time.perf_counter() - start) * 1000))
+
+@app.before_request
+def start_trace():
+    """Start span collection and, for sampled requests, cProfile"""
+    if not request.path.startswith('/api/'):
+        return
+    g.trace_start = time.perf_counter()
+    if ENABLE_TRACING:
+        g.trace_spans = []
+    if PROFILE_DIR and random.random() < PROFILE_SAMPLE_RATE:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            g.profiler = profiler
+        except ValueError:
+            # Python 3.12+ allows one active profiler per process (and it sees
+            # every thread), so overlapping sampled requests are skipped
+            logger.info("Profiler already active, not profiling this request")
+
+@app.after_request
+def finish_trace(response):
+    """Attach the span timeline to the response"""
+    if 'trace_start' not in g:
+        return response
+    total_ms = (time.perf_counter() - g.trace_start) * 1000
+    
+    spans = g.get('trace_spans')
+    if spans is not None:
+        # Server-Timing shows up in the browser devtools network panel
+        timeline = [f"{name};dur={ms:.1f}" for name, ms in spans]
+        timeline.append(f"total;dur={total_ms:.1f}")
+        response.headers['Server-Timing'] = ', '.join(timeline)
+    
+    return response
+
+@app.teardown_request
+def finish_profile(exc):
+    """Stop the profiler and dump it for slow requests (runs even if the view raised)"""
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return
+    profiler.disable()
+    total_ms = (time.perf_counter() - g.trace_start) * 1000
+    if total_ms < PROFILE_SLOW_MS:
+        return
+    
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = request.endpoint or request.path.strip('/').replace('/', '_')
+        filename = (f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{name}-"
+                    f"{int(total_ms)}ms-{uuid.uuid4().hex[:8]}.prof")
+        profile_path = os.path.join(PROFILE_DIR, filename)
+        profiler.dump_stats(profile_path)
+        logger.info(f"Slow request ({total_ms:.0f}ms), profile saved to {profile_path}")
+    except OSError as e:
+        logger.error(f"Error saving profile: {e}")
+
 # Google Sheets setup
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 
           'https://www.googleapis.com/auth/drive']
@@ -32,33 +114,82 @@ SCOPES = ['https://www.googleapis.com/auth/spreadsheets',
 def get_google_sheet():
     """Get or create Google Sheet"""
     try:
-        creds = Credentials.from_service_account_file(
-            'credentials.json', 
-            scopes=SCOPES
-        )
-        client = gspread.authorize(creds)
+        with trace_span('sheets_auth'):
+            creds = Credentials.from_service_account_file(
+                'credentials.json', 
+                scopes=SCOPES
+            )
+            client = gspread.authorize(creds)
         
-        try:
-            sheet = client.open('llm_eval_sheet').sheet1
-        except gspread.SpreadsheetNotFound:
-            spreadsheet = client.create('llm_eval_sheet')
-            sheet = spreadsheet.sheet1
-            headers = ['Timestamp', 'Prompt', 'Model', 'Response', 
-                      'Accuracy', 'Clarity', 'Creativity', 'Hallucination', 'Final Score']
-            sheet.append_row(headers)
-            spreadsheet.share('', perm_type='anyone', role='reader')
+        with trace_span('sheets_open'):
+            try:
+                sheet = client.open('llm_eval_sheet').sheet1
+            except gspread.SpreadsheetNotFound:
+                spreadsheet = client.create('llm_eval_sheet')
+                sheet = spreadsheet.sheet1
+                headers = ['Timestamp', 'Prompt', 'Model', 'Response', 
+                          'Accuracy', 'Clarity', 'Creativity', 'Hallucination', 'Final Score',
+                          'Session', 'Turn']
+                sheet.append_row(headers)
+                spreadsheet.share('', perm_type='anyone', role='reader')
         
         return sheet
     except Exception as e:
         logger.error(f"Error setting up Google Sheets: {e}")
         return None
 
-def get_gpt4_response(prompt):
+# Conversation sessions (multi-turn evaluation)
+# Sessions live in this process only, so run a single worker (e.g. gunicorn -w 1 --threads 8)
+MAX_CONVERSATION_SESSIONS = int(os.getenv('MAX_CONVERSATION_SESSIONS', '100'))
+# Bounds GPT-4 history (8k context); counts turns, not tokens, so long messages can still overflow
+MAX_CONVERSATION_TURNS = max(2, int(os.getenv('MAX_CONVERSATION_TURNS', '8')))
+HISTORY_TURN_LIMITS = {'gpt4': MAX_CONVERSATION_TURNS}
+
+class ConversationStore:
+    """In-memory per-session chat history, evicted least-recently-used first"""
+
+    def __init__(self, max_sessions):
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self):
+        """Start a new session and return (session_id, session)"""
+        session_id = uuid.uuid4().hex
+        session = {
+            'lock': threading.Lock(),
+            'turn': 0,
+            'history': {'gpt4': [], 'claude': [], 'gemini': []}
+        }
+        with self._lock:
+            self._sessions[session_id] = session
+            while len(self._sessions) > self.max_sessions:
+                evicted_id, _ = self._sessions.popitem(last=False)
+                logger.info(f"Evicted conversation session {evicted_id}")
+        return session_id, session
+
+    def get(self, session_id):
+        """Return the session and mark it as recently used, or None if unknown"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+            return session
+
+    def delete(self, session_id):
+        """Drop a session, returning True if it existed"""
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+conversations = ConversationStore(MAX_CONVERSATION_SESSIONS)
+
+def get_gpt4_response(prompt, history=None):
     """Get response from GPT-4 with better error handling"""
     try:
+        messages = list(history or []) + [{"role": "user", "content": prompt}]
         response = openai_client.chat.completions.create(
             model="gpt-4",
-            messages=[{"role": "user", "content": prompt}],
+            messages=messages,
             max_tokens=500,
             timeout=30
         )
@@ -77,13 +208,22 @@ def get_gpt4_response(prompt):
         else:
             return f"Error: GPT-4 service error - {error_msg[:100]}"
 
-def get_claude_response(prompt):
+def get_claude_response(prompt, history=None):
     """Get response from Claude with better error handling"""
     try:
+        messages = [dict(turn) for turn in history or []]
+        if messages:
+            # Mark the end of the shared conversation prefix for prompt caching
+            messages[-1]['content'] = [{
+                "type": "text",
+                "text": messages[-1]['content'],
+                "cache_control": {"type": "ephemeral"}
+            }]
+        messages.append({"role": "user", "content": prompt})
         response = anthropic_client.messages.create(
             model="claude-3-5-sonnet-20241022",
             max_tokens=500,
-            messages=[{"role": "user", "content": prompt}],
+            messages=messages,
             timeout=30
         )
         return response.content[0].text
@@ -101,11 +241,19 @@ def get_claude_response(prompt):
         else:
             return f"Error: Claude service error - {error_msg[:100]}"
 
-def get_gemini_response(prompt):
+def get_gemini_response(prompt, history=None):
     """Get response from Gemini with better error handling"""
     try:
         model = genai.GenerativeModel('gemini-1.5-flash')  # Updated model name
-        response = model.generate_content(prompt)
+        if history:
+            chat = model.start_chat(history=[
+                {'role': 'model' if turn['role'] == 'assistant' else 'user',
+                 'parts': [turn['content']]}
+                for turn in history
+            ])
+            response = chat.send_message(prompt)
+        else:
+            response = model.generate_content(prompt)
         return response.text
     except Exception as e:
         error_msg = str(e)
@@ -121,6 +269,12 @@ def get_gemini_response(prompt):
         else:
             return f"Error: Gemini service error - {error_msg[:100]}"
 
+MODEL_FUNCTIONS = {
+    'gpt4': get_gpt4_response,
+    'claude': get_claude_response,
+    'gemini': get_gemini_response
+}
+
 @app.route('/')
 def index():
     """Serve the main page"""
@@ -129,7 +283,8 @@ def index():
 @app.route('/api/evaluate', methods=['POST'])
 def evaluate_prompt():
     """Evaluate prompt across all LLMs"""
-    data = request.json
+    with trace_span('json_parse'):
+        data = request.json
     prompt = data.get('prompt', '')
     
     if not prompt:
@@ -138,26 +293,100 @@ def evaluate_prompt():
     logger.info(f"Evaluating prompt: {prompt[:50]}...")
     
     # Get responses from all models (they handle their own errors)
-    responses = {
-        'gpt4': get_gpt4_response(prompt),
-        'claude': get_claude_response(prompt),
-        'gemini': get_gemini_response(prompt)
-    }
+    responses = {}
+    for model, get_response in MODEL_FUNCTIONS.items():
+        with trace_span(f'provider_{model}'):
+            responses[model] = get_response(prompt)
     
     # Log which models succeeded/failed
     for model, response in responses.items():
         status = "❌ Error" if response.startswith("Error:") else "✅ Success"
         logger.info(f"{model}: {status}")
     
-    return jsonify({'responses': responses})
+    with trace_span('json_serialize'):
+        result = jsonify({'responses': responses})
+    return result
+
+@app.route('/api/conversation', methods=['POST'])
+def continue_conversation():
+    """Send the next turn of a multi-turn conversation to all LLMs"""
+    with trace_span('json_parse'):
+        data = request.json
+    message = data.get('message', '')
+    
+    if not message:
+        return jsonify({'error': 'No message provided'}), 400
+    if not isinstance(message, str):
+        return jsonify({'error': 'message must be a string'}), 400
+    
+    session_id = data.get('session_id')
+    if session_id is None:
+        session_id, session = conversations.create()
+    elif not isinstance(session_id, str):
+        return jsonify({'error': 'session_id must be a string'}), 400
+    else:
+        session = conversations.get(session_id)
+        if session is None:
+            return jsonify({'error': 'Unknown or expired session'}), 404
+    
+    # One turn at a time per session, otherwise appends from concurrent turns interleave
+    if not session['lock'].acquire(blocking=False):
+        return jsonify({'error': 'A turn is already in progress for this session'}), 409
+    
+    try:
+        logger.info(f"Conversation {session_id}: {message[:50]}...")
+        session['turn'] += 1
+        turn = session['turn']
+        history = session['history']
+        responses = {}
+        for model, get_response in MODEL_FUNCTIONS.items():
+            with trace_span(f'provider_{model}'):
+                response = get_response(message, history[model])
+            responses[model] = response
+            
+            # Only keep successful turns so each history stays user/assistant alternating
+            if response.startswith("Error:"):
+                logger.info(f"{model}: ❌ Error")
+                continue
+            history[model].append({"role": "user", "content": message})
+            history[model].append({"role": "assistant", "content": response})
+            
+            # Drop the older half at once so Claude's cached prefix stays stable between trims
+            limit = HISTORY_TURN_LIMITS.get(model)
+            if limit and len(history[model]) > 2 * limit:
+                del history[model][:-2 * (limit // 2)]
+            logger.info(f"{model}: ✅ Success")
+        turns = {model: len(model_turns) // 2 for model, model_turns in history.items()}
+    finally:
+        session['lock'].release()
+    
+    with trace_span('json_serialize'):
+        result = jsonify({
+            'session_id': session_id,
+            'turn': turn,
+            'responses': responses,
+            'turns': turns
+        })
+    return result
+
+@app.route('/api/conversation/<session_id>', methods=['DELETE'])
+def end_conversation(session_id):
+    """Discard a conversation session"""
+    if not conversations.delete(session_id):
+        return jsonify({'error': 'Unknown session'}), 404
+    return jsonify({'success': True})
 
 @app.route('/api/submit_ratings', methods=['POST'])
 def submit_ratings():
     """Submit ratings to Google Sheets"""
-    data = request.json
+    with trace_span('json_parse'):
+        data = request.json
     prompt = data.get('prompt')
     responses = data.get('responses')
     ratings = data.get('ratings')
+    # Optional, set when rating a turn from /api/conversation
+    session_id = data.get('session_id', '')
+    turn = data.get('turn', '')
     
     if not all([prompt, responses, ratings]):
         return jsonify({'error': 'Missing required data'}), 400
@@ -198,21 +427,26 @@ def submit_ratings():
             rating.get('clarity', ''),
             rating.get('creativity', ''),
             rating.get('hallucination', ''),
-            rating.get('final', '')
+            rating.get('final', ''),
+            session_id,
+            turn
         ]
         
         try:
-            sheet.append_row(row)
+            with trace_span(f'sheets_write_{model}'):
+                sheet.append_row(row)
             saved_count += 1
             logger.info(f"Saved rating for {model}")
         except Exception as e:
             logger.error(f"Error saving {model} rating: {e}")
     
-    return jsonify({
-        'success': True,
-        'saved_count': saved_count,
-        'sheet_url': sheet.spreadsheet.url
-    })
+    with trace_span('json_serialize'):
+        result = jsonify({
+            'success': True,
+            'saved_count': saved_count,
+            'sheet_url': sheet.spreadsheet.url
+        })
+    return result
 
 @app.route('/api/health', methods=['GET'])
 def health_check():